@@ -0,0 +1,127 @@
+"""
+Benchmark - Unix domain socket vs loopback TCP as the local hop into SocketSwap
+
+Setup:
+    No external services needed, a TCP echo server and a TCP sink server are started in background threads.
+    python examples/benchmark_uds.py
+
+The proxy listens on 127.0.0.1:2224 and on a Unix domain socket at the same time, both relay to the same servers.
+For each listener the benchmark measures the request/response latency of small messages on one connection
+through the echo server and the throughput of a bulk transfer into the sink server, which only reads and
+confirms the byte count. Echoing the bulk transfer back would fill the socket buffers in both directions and
+block the relay thread, which serves both directions of a connection.
+"""
+import os
+import struct
+import socket
+import tempfile
+import threading
+import time
+from SocketSwap import SocketSwapContext
+
+ECHO_PORT = 4445
+SINK_PORT = 4447
+PROXY_PORT = 2224
+ROUNDTRIPS = 5000
+MESSAGE = b"x" * 64
+BULK_BYTES = 64 * 1024 * 1024
+BULK_HEADER = struct.Struct("!Q")
+
+
+def serve(port, handler):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", port))
+    server.listen(100)
+
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=handler, args=(conn,), daemon=True).start()
+
+
+def echo(conn):
+    with conn:
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+
+
+def sink(conn):
+    # reads the announced number of bytes and answers with the number of bytes it received
+    with conn:
+        expected = BULK_HEADER.unpack(receive_exactly(conn, BULK_HEADER.size))[0]
+        received = 0
+        while received < expected:
+            data = conn.recv(min(65536, expected - received))
+            if not data:
+                break
+            received += len(data)
+        conn.sendall(BULK_HEADER.pack(received))
+
+
+def socket_factory(port):
+    remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    remote_socket.connect(("127.0.0.1", port))
+    return remote_socket
+
+
+def receive_exactly(sock, nbytes):
+    data = bytearray()
+    while len(data) < nbytes:
+        chunk = sock.recv(min(65536, nbytes - len(data)))
+        if not chunk:
+            raise ConnectionError("connection closed during benchmark")
+        data += chunk
+    return data
+
+
+def measure_latency(family, address):
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(address)
+        if family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        start = time.perf_counter()
+        for _ in range(ROUNDTRIPS):
+            sock.sendall(MESSAGE)
+            receive_exactly(sock, len(MESSAGE))
+        return (time.perf_counter() - start) / ROUNDTRIPS
+
+
+def measure_throughput(family, address):
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(address)
+        chunk = b"y" * 65536
+        start = time.perf_counter()
+        sock.sendall(BULK_HEADER.pack(BULK_BYTES))
+        for _ in range(BULK_BYTES // len(chunk)):
+            sock.sendall(chunk)
+        received = BULK_HEADER.unpack(receive_exactly(sock, BULK_HEADER.size))[0]
+        elapsed = time.perf_counter() - start
+        if received != BULK_BYTES:
+            raise ConnectionError(f"sink received {received} of {BULK_BYTES} bytes")
+        return BULK_BYTES / elapsed
+
+
+def benchmark_uds_vs_tcp():
+    """
+    This function compares the cost of the local hop into the proxy for a TCP loopback client and a Unix domain socket client.
+    The relay and the remote side are the same for both, so the difference is the local hop.
+    """
+    threading.Thread(target=serve, args=(ECHO_PORT, echo), daemon=True).start()
+    threading.Thread(target=serve, args=(SINK_PORT, sink), daemon=True).start()
+    unix_socket = os.path.join(tempfile.mkdtemp(), "socketswap.sock")
+
+    with SocketSwapContext(socket_factory, [ECHO_PORT], "127.0.0.1", PROXY_PORT, local_unix_socket=unix_socket) as swap:
+        for name, family, address in [("loopback TCP", socket.AF_INET, ("127.0.0.1", PROXY_PORT)),
+                                      ("Unix socket", socket.AF_UNIX, unix_socket)]:
+            swap.update_factory(socket_factory_args=[ECHO_PORT])
+            latency = measure_latency(family, address)
+            swap.update_factory(socket_factory_args=[SINK_PORT])
+            throughput = measure_throughput(family, address)
+            print(f"{name:>12}: {latency * 1e6:8.1f} us per roundtrip, {throughput / 1024 / 1024:8.1f} MiB/s")
+
+
+if __name__ == '__main__':
+    benchmark_uds_vs_tcp()
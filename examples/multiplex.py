@@ -0,0 +1,47 @@
+"""
+Demo Szenario - Multiplexing many short-lived connections over two tunnel sockets
+
+Setup:
+    A TCP Hello World Server on Port 4444 example: https://gist.github.com/fyx99/cb6389e3c1942729cdbfc7ad3a9e1c71
+
+The MultiplexServer is the far end of the tunnels. In a real deployment it runs next to the target, e.g. behind the
+SAP Cloud Connector, and the socket_factory creates the expensive tunnel socket to it. Here it runs locally as a stand-in.
+"""
+import socket
+from SocketSwap import SocketSwapContext, MultiplexServer
+
+
+def target_factory():
+    target_host = "localhost"
+    target_port = 4444
+    remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    remote_socket.connect((target_host, target_port))
+    return remote_socket
+
+def tunnel_factory(far_end_address):
+    tunnel_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tunnel_socket.connect(tuple(far_end_address))
+    return tunnel_socket
+
+def multiplexed_traffic_redirect():
+    """
+    This function demos the multiplexing mode of the SocketSwapContext-Manager.
+    It exposes a local proxy on the localhost 127.0.0.1 on port 2225
+    All 100 connections are relayed over at most 2 sockets created by the tunnel_factory
+    """
+    
+    with MultiplexServer(target_factory, [], "127.0.0.1", 0) as far_end:
+        with SocketSwapContext(tunnel_factory, [far_end.address], "127.0.0.1", 2225, multiplex_tunnels=2) as swap:
+            for _ in range(100):
+                local_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                local_socket.connect(("127.0.0.1", 2225))
+                local_socket.send(b"")
+                response = local_socket.recv(4096)
+                local_socket.close()
+            print(response)
+            print(swap.stats()["multiplex"])    # {'tunnels': 2, 'streams': ...}
+
+
+if __name__ == '__main__':
+    # for testing
+    multiplexed_traffic_redirect()
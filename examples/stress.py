@@ -0,0 +1,135 @@
+"""
+Stress harness - Driving thousands of concurrent short and long connections through the relay loop
+
+Setup:
+    No external services needed, a TCP echo server is started in a background thread.
+    Every proxied connection uses 4 file descriptors, raise the limit for large runs: ulimit -n 65536
+    python examples/stress.py --short 5000 --long 200 --concurrency 500 --profile sample
+
+Short connections connect, send one message, wait for the echo and close, like the queries of a chatty DB client.
+Long connections stay open and do many roundtrips, like a connection pool.
+The proxy runs with the per-phase timing counters enabled, they are printed at the end together with the
+connection latencies, so optimization work on the relay can target measured costs.
+"""
+import time
+import socket
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from SocketSwap import SocketSwapContext
+
+ECHO_PORT = 4446
+PROXY_PORT = 2226
+
+
+def echo_server():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", ECHO_PORT))
+    server.listen(4096)
+
+    def echo(conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                conn.sendall(data)
+
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+
+def socket_factory():
+    remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    remote_socket.connect(("127.0.0.1", ECHO_PORT))
+    return remote_socket
+
+
+def roundtrip(sock, message):
+    sock.sendall(message)
+    received = 0
+    while received < len(message):
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError("connection closed by the proxy")
+        received += len(data)
+
+
+def short_connection(message):
+    started = time.perf_counter()
+    with socket.create_connection(("127.0.0.1", PROXY_PORT)) as sock:
+        roundtrip(sock, message)
+    return time.perf_counter() - started
+
+
+def long_connection(message, roundtrips):
+    with socket.create_connection(("127.0.0.1", PROXY_PORT)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        latencies = []
+        for _ in range(roundtrips):
+            started = time.perf_counter()
+            roundtrip(sock, message)
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+
+def percentiles(latencies):
+    if not latencies:
+        return "no samples"
+    latencies = sorted(latencies)
+    pick = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+    return f"p50 {pick(0.5):.2f} ms, p99 {pick(0.99):.2f} ms, max {latencies[-1] * 1000:.2f} ms"
+
+
+def run(futures):
+    results, errors = [], 0
+    for future in futures:
+        try:
+            results.append(future.result())
+        except OSError:
+            errors += 1
+    return results, errors
+
+
+def stress(short, long, concurrency, roundtrips, message_size, profile, profile_path):
+    """
+    This function runs the short and the long connections at the same time through a SocketSwapContext
+    and prints the connection latencies and the per-phase timing counters of the proxy process.
+    """
+    threading.Thread(target=echo_server, daemon=True).start()
+    message = b"x" * message_size
+
+    with SocketSwapContext(socket_factory, [], "127.0.0.1", PROXY_PORT, profile=profile, profile_path=profile_path) as swap:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max(long, 1)) as long_pool, ThreadPoolExecutor(max(concurrency, 1)) as short_pool:
+            long_futures = [long_pool.submit(long_connection, message, roundtrips) for _ in range(long)]
+            short_futures = [short_pool.submit(short_connection, message) for _ in range(short)]
+            short_latencies, short_errors = run(short_futures)
+            long_results, long_errors = run(long_futures)
+        elapsed = time.perf_counter() - started
+
+        print(f"{short} short and {long} long connections in {elapsed:.2f}s")
+        print(f"short connections: {percentiles(short_latencies)}, {short_errors} errors")
+        print(f"long connection roundtrips: {percentiles([l for r in long_results for l in r])}, {long_errors} errors")
+
+        result = swap.profile_dump()
+        print("proxy phases:")
+        for phase, summary in sorted(result["phases"].items(), key=lambda item: -item[1]["total"]):
+            print(f"{phase:>12}: {summary['count']:>9} times {summary['total']:9.3f}s total {summary['max'] * 1000:9.3f} ms max")
+        if result["profile_path"]:
+            print(f"profile written to {result['profile_path']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--short", type=int, default=2000, help="number of short connections")
+    parser.add_argument("--long", type=int, default=100, help="number of long connections")
+    parser.add_argument("--concurrency", type=int, default=200, help="concurrent short connections")
+    parser.add_argument("--roundtrips", type=int, default=200, help="roundtrips per long connection")
+    parser.add_argument("--message-size", type=int, default=512, help="bytes per message")
+    parser.add_argument("--profile", choices=["phases", "cprofile", "sample"], default="phases")
+    parser.add_argument("--profile-path", default=None)
+    args = parser.parse_args()
+    stress(args.short, args.long, args.concurrency, args.roundtrips, args.message_size, args.profile, args.profile_path)
@@ -10,9 +10,11 @@ __credits__ = 'No credits'
 
 from SocketSwap.context_manager import SocketSwapContext
 from SocketSwap.proxy import start_local_proxy
+from SocketSwap.multiplex import MultiplexServer
 
 
 __all__ = [
     SocketSwapContext,
-    start_local_proxy
+    start_local_proxy,
+    MultiplexServer
 ]
\ No newline at end of file
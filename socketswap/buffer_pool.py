@@ -0,0 +1,112 @@
+"""
+Module providing a shared pool of fixed-size receive buffers for the proxy threads
+"""
+import threading
+from typing import Dict, Optional
+
+
+class BufferPool:
+    """
+    A thread-safe pool of fixed-size bytearray slabs shared by all connections of a proxy process.
+
+    Parameters:
+    - slab_size (int): size in bytes of every slab handed out by the pool.
+    - max_slabs (int): global memory budget expressed in slabs. The pool never holds more than
+      slab_size * max_slabs bytes of buffer memory.
+
+    Notes:
+    - Slabs are allocated lazily and are kept for reuse once released, so a busy proxy reaches a
+      steady state without allocating a new buffer for every chunk it relays.
+    - When the budget is exhausted acquire() returns None (or waits, if a timeout is given). Callers
+      are expected to stop reading from their socket, which leaves the data in the kernel buffer and
+      pushes back on the sender.
+    """
+
+    def __init__(self, slab_size: int = 4096, max_slabs: int = 1024):
+        if slab_size <= 0 or max_slabs <= 0:
+            raise ValueError("slab_size and max_slabs must be positive")
+        self.slab_size = slab_size
+        self.max_slabs = max_slabs
+        self._free = []
+        self._allocated = 0
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._exhausted = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout: Optional[float] = None) -> Optional[bytearray]:
+        """
+        Take a slab from the pool.
+
+        Parameters:
+        - timeout (float): seconds to wait for a slab if the budget is exhausted. None or 0 returns immediately.
+
+        Returns:
+        - A bytearray of slab_size bytes, or None if the budget is exhausted.
+        """
+        with self._cond:
+            if self._in_use >= self.max_slabs:
+                self._exhausted += 1
+                if not timeout:
+                    return None
+                if not self._cond.wait_for(lambda: self._in_use < self.max_slabs, timeout):
+                    return None
+            if self._free:
+                slab = self._free.pop()
+            else:
+                slab = bytearray(self.slab_size)
+                self._allocated += 1
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+            return slab
+
+    def release(self, slab: bytearray):
+        """Return a slab previously handed out by acquire() to the pool."""
+        with self._cond:
+            self._in_use -= 1
+            if self._allocated > self.max_slabs:
+                # the budget was lowered while this slab was in use, let it go
+                self._allocated -= 1
+            else:
+                self._free.append(slab)
+            self._cond.notify()
+
+    def resize(self, max_slabs: int):
+        """
+        Change the global memory budget of the pool.
+
+        Parameters:
+        - max_slabs (int): the new budget in slabs.
+
+        Notes:
+        - Lowering the budget frees surplus idle slabs right away. Slabs in use above the new budget are
+          dropped when they are released, so the footprint converges to the new budget.
+        """
+        if max_slabs <= 0:
+            raise ValueError("max_slabs must be positive")
+        with self._cond:
+            self.max_slabs = max_slabs
+            while self._free and self._allocated > max_slabs:
+                self._free.pop()
+                self._allocated -= 1
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Report the current buffer pool usage.
+
+        Returns:
+        - A dict with the slab size, the budget, the number of allocated, free and in use slabs, the peak
+          number of slabs in use and how often a caller found the budget exhausted.
+        """
+        with self._cond:
+            return {
+                "slab_size": self.slab_size,
+                "max_slabs": self.max_slabs,
+                "allocated": self._allocated,
+                "free": len(self._free),
+                "in_use": self._in_use,
+                "peak_in_use": self._peak_in_use,
+                "bytes_allocated": self._allocated * self.slab_size,
+                "exhausted": self._exhausted,
+            }
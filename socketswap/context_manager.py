@@ -2,6 +2,8 @@
 Module to wrap the TCP proxy in a context manager daemon process
 """
 import multiprocessing
+import pickle
+import threading
 import SocketSwap.proxy as proxy
 import time
 import logging
@@ -11,32 +13,121 @@ logger = logging.getLogger("SocketSwap")
 logger.addHandler(logging.NullHandler())
 logger.setLevel(logging.DEBUG)
 
+# default of reload_certs() arguments that are not passed, None clears a setting
+_UNCHANGED = object()
+
 
 class SocketSwapContext:
-    
-    def __init__(self, *args):
+
+    def __init__(self, *args, **kwargs):
         self.args = args
-    
+        self.kwargs = kwargs
+        self.control_lock = threading.Lock()
+        self.control_sequence = 0
+
     def __enter__(self):
         logger.info("Starting Proxy Server")
         log_queue = multiprocessing.Queue()
+        self.control_conn, proxy_control_conn = multiprocessing.Pipe()
 
-        self.proxy_process = multiprocessing.Process(target=proxy.start_local_proxy, args=([log_queue, *self.args]))
+        self.proxy_process = multiprocessing.Process(target=proxy.start_local_proxy, args=([log_queue, *self.args]), kwargs={**self.kwargs, "control_conn": proxy_control_conn})
         self.proxy_process.daemon = True
         self.proxy_process.start()
-        log_queue_listener = QueueListener(log_queue, *logger.handlers)
-        log_queue_listener.start()
+        self.log_queue_listener = QueueListener(log_queue, *logger.handlers)
+        self.log_queue_listener.start()
         time.sleep(1)
         return self
-    
+
     def __exit__(self, exc_type, exc_value, traceback):
         logger.info("Exiting proxy server")
         time.sleep(0.1)
         self.proxy_process.terminate()
+        # give the proxy process the chance to clean up, e.g. to write its profile
+        self.proxy_process.join(5)
+        self.control_conn.close()
+        # deliver the records the proxy process logged on its way out, e.g. the last trace batch
+        self.log_queue_listener.stop()
         if exc_type:
             logger.error(str(exc_type))
             logger.error(str(exc_value))
             logger.error(str(traceback))
-        
 
-        
\ No newline at end of file
+    def control(self, command, timeout=5.0, **arguments):
+        """
+        Send a command to the running proxy process and wait for its answer.
+
+        Parameters:
+        - command (str): the control command, see SocketSwap.proxy.handle_control_command.
+        - timeout (float): seconds to wait for the answer.
+        - arguments: the arguments of the command.
+
+        Returns:
+        - The result of the command.
+
+        Raises:
+        - ValueError: if the proxy rejected the command, e.g. because of an invalid setting.
+        - RuntimeError: if the proxy process did not answer in time.
+        """
+        with self.control_lock:
+            self.control_sequence += 1
+            sequence = self.control_sequence
+            # the arguments are pickled separately, so the proxy can answer even if it fails to unpickle them
+            self.control_conn.send((sequence, command, pickle.dumps(arguments)))
+            deadline = time.monotonic() + timeout
+            while True:
+                if not self.control_conn.poll(max(0, deadline - time.monotonic())):
+                    raise RuntimeError(f"Proxy process did not answer the {command} command")
+                answer_sequence, status, result = self.control_conn.recv()
+                # late answers to commands that timed out before are skipped
+                if answer_sequence == sequence:
+                    break
+        if status != "ok":
+            raise ValueError(result)
+        return result
+
+    def reconfigure(self, **settings):
+        """
+        Change settings of the running proxy without restarting it.
+
+        Parameters:
+        - settings: any of socket_factory, socket_factory_args, server_key, server_certificate, client_key,
+          client_certificate, use_ssl, max_buffers and max_connection_buffers.
+
+        Notes:
+        - New settings apply to connections accepted afterwards, established connections keep their settings.
+          Only max_buffers applies immediately: the buffer pool is shared, so its new budget limits established
+          connections as well.
+        - A new socket_factory is pickled to the proxy process, so it has to be a module level function.
+        """
+        self.control("configure", **settings)
+
+    def update_factory(self, socket_factory=None, socket_factory_args=None):
+        """Swap the socket factory and/or its arguments, e.g. to pass a rotated token."""
+        settings = {"socket_factory": socket_factory, "socket_factory_args": socket_factory_args}
+        self.reconfigure(**{key: value for key, value in settings.items() if value is not None})
+
+    def reload_certs(self, server_key=_UNCHANGED, server_certificate=_UNCHANGED, client_key=_UNCHANGED, client_certificate=_UNCHANGED):
+        """
+        Switch to new certificate and key files. The files are loaded once to validate them before they are used.
+
+        Arguments that are not passed keep their setting, None clears it, e.g. reload_certs(client_key=None,
+        client_certificate=None) stops presenting a client certificate. Client key and certificate go in pairs.
+        """
+        settings = {"server_key": server_key, "server_certificate": server_certificate, "client_key": client_key, "client_certificate": client_certificate}
+        self.reconfigure(**{key: value for key, value in settings.items() if value is not _UNCHANGED})
+
+    def set_limits(self, max_buffers=None, max_connection_buffers=None):
+        """Change the buffer pool budget and the per-connection buffer cap. Not available with multiplex_tunnels."""
+        settings = {"max_buffers": max_buffers, "max_connection_buffers": max_connection_buffers}
+        self.reconfigure(**{key: value for key, value in settings.items() if value is not None})
+
+    def stats(self):
+        """Return the statistics of the running proxy, e.g. its buffer pool usage and per-phase timing counters."""
+        return self.control("stats")
+
+    def profile_dump(self):
+        """Write the profile of the running proxy (profile option) and return its per-phase timing counters."""
+        return self.control("profile_dump", timeout=30.0)
+
+
+
@@ -0,0 +1,496 @@
+"""
+Module to multiplex many proxied connections as logical streams over a few tunnel sockets
+
+Frames on a tunnel socket consist of a 9 byte header (frame type, stream ID, payload length) and the payload.
+The local end opens a stream for every client connection (OPEN), both ends relay the stream data in DATA frames
+and signal the end of their direction with CLOSE. RESET aborts a stream in both directions.
+Every stream direction has its own flow control window: a sender may only have STREAM_WINDOW bytes in flight,
+the receiver grants new credit with WINDOW frames once it forwarded the data, so one slow stream can not make
+the other side buffer without bounds or stall the other streams of its tunnel.
+"""
+import socket
+import struct
+import queue
+import logging
+import itertools
+import threading
+from typing import Callable, Dict, List, Optional
+
+from SocketSwap.tracing import ConnectionTrace, next_connection_id
+from SocketSwap.profiling import PhaseTimers, NullPhaseTimers
+
+
+logger = logging.getLogger("SocketSwapProxy.multiplex")
+
+FRAME_HEADER = struct.Struct("!BII")
+WINDOW_CREDIT = struct.Struct("!I")
+
+OPEN = 1
+DATA = 2
+CLOSE = 3
+WINDOW = 4
+RESET = 5
+
+MAX_FRAME_PAYLOAD = 16384
+STREAM_WINDOW = 262144
+
+_tunnel_ids = itertools.count(1)
+
+
+def recv_exactly(sock: socket.socket, nbytes: int) -> Optional[bytearray]:
+    """
+    Receive exactly nbytes from a socket.
+
+    Parameters:
+    - sock (socket.socket): the socket to read from.
+    - nbytes (int): the number of bytes to read.
+
+    Returns:
+    - A bytearray of nbytes bytes, or None if the connection was closed before.
+    """
+    buffer = bytearray(nbytes)
+    view = memoryview(buffer)
+    received = 0
+    while received < nbytes:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return buffer
+
+
+class Stream:
+    """
+    A logical connection multiplexed over a tunnel, relaying between the tunnel and a local socket.
+
+    Parameters:
+    - tunnel (Tunnel): the tunnel carrying the stream.
+    - stream_id (int): the ID of the stream, unique within its tunnel.
+    - trace (ConnectionTrace): the trace of the connection, counts the relayed bytes.
+
+    Notes:
+    - Two threads relay a stream once a local socket is attached: one reads the local socket and sends DATA frames
+      while the send window allows, the other writes the received DATA frames to the local socket and grants credit.
+    - The stream ends when both directions are closed or when it is reset.
+    - receive_window is the credit the peer has left, a peer sending DATA beyond it gets the stream reset,
+      so a stream never queues more than STREAM_WINDOW bytes.
+    """
+
+    def __init__(self, tunnel: "Tunnel", stream_id: int, trace: Optional[ConnectionTrace] = None):
+        self.tunnel = tunnel
+        self.stream_id = stream_id
+        self.trace = trace or ConnectionTrace(next_connection_id(), "")
+        self.local_socket = None
+        self.window = STREAM_WINDOW
+        self.window_cond = threading.Condition()
+        self.receive_window = STREAM_WINDOW
+        self.incoming = queue.Queue()
+        self.open_directions = 2
+        self.lock = threading.Lock()
+        self.was_reset = False
+
+    def attach(self, local_socket: socket.socket):
+        """Attach the local socket and start relaying."""
+        with self.lock:
+            self.local_socket = local_socket
+            was_reset = self.was_reset
+        if was_reset:
+            local_socket.close()
+            return
+        for pump, name in ((self.pump_out, "SocketSwapStreamOut"), (self.pump_in, "SocketSwapStreamIn")):
+            target = self.tunnel.phase_timers.wrap(pump)
+            if self.tunnel.profiler:
+                target = self.tunnel.profiler.wrap(target)
+            threading.Thread(target=target, name=f"{name}-{self.stream_id}", daemon=True).start()
+
+    def deliver(self, payload: Optional[bytearray]) -> bool:
+        """
+        Queue data received from the tunnel, None marks the end of the incoming direction.
+
+        Returns:
+        - False if the payload exceeds the credit granted to the peer, the payload is not queued then.
+        """
+        if payload:
+            with self.lock:
+                if self.was_reset:
+                    return True
+                if len(payload) > self.receive_window:
+                    return False
+                self.receive_window -= len(payload)
+        self.incoming.put(payload)
+        return True
+
+    def grant(self, credit: int):
+        """Extend the send window by credit bytes."""
+        with self.window_cond:
+            self.window += credit
+            self.window_cond.notify_all()
+
+    def reset(self):
+        """Abort both directions of the stream locally."""
+        with self.lock:
+            self.was_reset = True
+            local_socket = self.local_socket
+        with self.window_cond:
+            self.window_cond.notify_all()
+        self.incoming.put(None)
+        if local_socket is None:
+            # nothing is relaying yet, so no relay thread will finish the stream
+            self.tunnel.remove(self.stream_id)
+            self.trace.close("reset")
+            return
+        try:
+            local_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def abort(self):
+        """Reset the stream on both ends of the tunnel."""
+        try:
+            self.tunnel.send_frame(RESET, self.stream_id)
+        except OSError:
+            pass
+        self.reset()
+
+    def pump_out(self):
+        """relays the local socket to the tunnel"""
+        phase_timers = self.tunnel.phase_timers
+        try:
+            while True:
+                started = phase_timers.start()
+                with self.window_cond:
+                    self.window_cond.wait_for(lambda: self.window > 0 or self.was_reset)
+                    size = min(self.window, MAX_FRAME_PAYLOAD)
+                phase_timers.stop("window", started)
+                if self.was_reset:
+                    return
+                started = phase_timers.start()
+                data = self.local_socket.recv(size)
+                phase_timers.stop("recv", started)
+                if self.was_reset:
+                    return
+                if not data:
+                    self.tunnel.send_frame(CLOSE, self.stream_id)
+                    return
+                with self.window_cond:
+                    self.window -= len(data)
+                self.trace.transferred("out", len(data))
+                started = phase_timers.start()
+                self.tunnel.send_frame(DATA, self.stream_id, data)
+                phase_timers.stop("send", started)
+        except OSError as e:
+            if not self.was_reset:
+                logger.error(f"Stream {self.stream_id} on tunnel {self.tunnel.name} failed: {e}")
+                self.abort()
+        finally:
+            self.finish_direction()
+
+    def pump_in(self):
+        """relays the tunnel to the local socket"""
+        phase_timers = self.tunnel.phase_timers
+        consumed = 0
+        try:
+            while True:
+                started = phase_timers.start()
+                payload = self.incoming.get()
+                phase_timers.stop("wait", started)
+                if payload is None:
+                    if not self.was_reset:
+                        self.local_socket.shutdown(socket.SHUT_WR)
+                    return
+                started = phase_timers.start()
+                self.local_socket.sendall(payload)
+                phase_timers.stop("send", started)
+                self.trace.transferred("in", len(payload))
+                consumed += len(payload)
+                # grant credit in batches, but never leave the sender waiting on data that was already forwarded
+                if consumed >= STREAM_WINDOW // 4 or self.incoming.empty():
+                    with self.lock:
+                        self.receive_window += consumed
+                    self.tunnel.send_frame(WINDOW, self.stream_id, WINDOW_CREDIT.pack(consumed))
+                    consumed = 0
+        except OSError as e:
+            if not self.was_reset:
+                logger.error(f"Stream {self.stream_id} on tunnel {self.tunnel.name} failed: {e}")
+                self.abort()
+        finally:
+            self.finish_direction()
+
+    def finish_direction(self):
+        with self.lock:
+            self.open_directions -= 1
+            done = self.open_directions == 0
+        if done:
+            self.local_socket.close()
+            self.tunnel.remove(self.stream_id)
+            self.trace.close("reset" if self.was_reset else "closed")
+
+
+class Tunnel:
+    """
+    A tunnel socket carrying multiplexed streams.
+
+    Parameters:
+    - sock (socket.socket): the tunnel socket, e.g. created by a socket factory.
+    - on_open (Callable): called with the tunnel and the new Stream when the peer opens a stream. Tunnels without
+      on_open only open streams themselves, see open_stream().
+    - phase_timers (PhaseTimers): the timing counters the relay threads of the streams account to.
+    - profiler: a SocketSwap.profiling profiler the relay threads of the streams are wrapped with.
+
+    Notes:
+    - A reader thread demultiplexes the incoming frames. Frames are sent as a whole under a lock, so the relay
+      threads of all streams can share the socket.
+    """
+
+    def __init__(self, sock: socket.socket, on_open: Optional[Callable[["Tunnel", Stream], None]] = None, phase_timers: Optional[PhaseTimers] = None, profiler=None):
+        self.sock = sock
+        self.on_open = on_open
+        self.phase_timers = phase_timers or NullPhaseTimers()
+        self.profiler = profiler
+        self.name = f"tunnel-{next(_tunnel_ids)}"
+        self.streams: Dict[int, Stream] = {}
+        self.next_stream_id = 1
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    def start(self):
+        """Start the reader thread."""
+        threading.Thread(target=self.read_loop, name=f"SocketSwap-{self.name}", daemon=True).start()
+        return self
+
+    @property
+    def stream_count(self) -> int:
+        return len(self.streams)
+
+    def send_frame(self, frame_type: int, stream_id: int, payload: bytes = b""):
+        """Send a single frame, raises OSError if the tunnel is broken."""
+        frame = FRAME_HEADER.pack(frame_type, stream_id, len(payload)) + payload
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def open_stream(self, local_socket: socket.socket, trace: Optional[ConnectionTrace] = None) -> Stream:
+        """Open a new stream to the peer relaying the given local socket."""
+        with self.lock:
+            if self.closed:
+                raise OSError(f"Tunnel {self.name} is closed")
+            stream = Stream(self, self.next_stream_id, trace)
+            self.next_stream_id += 1
+            self.streams[stream.stream_id] = stream
+        try:
+            self.send_frame(OPEN, stream.stream_id)
+        except OSError:
+            self.remove(stream.stream_id)
+            raise
+        stream.attach(local_socket)
+        return stream
+
+    def remove(self, stream_id: int):
+        with self.lock:
+            self.streams.pop(stream_id, None)
+
+    def read_loop(self):
+        """demultiplexes the frames received on the tunnel socket"""
+        try:
+            while True:
+                header = recv_exactly(self.sock, FRAME_HEADER.size)
+                if header is None:
+                    break
+                frame_type, stream_id, length = FRAME_HEADER.unpack(header)
+                # the length comes from the peer, a broken or hostile peer must not make us allocate up to 4 GiB
+                if length > MAX_FRAME_PAYLOAD or (frame_type == WINDOW and length != WINDOW_CREDIT.size):
+                    logger.error(f"Tunnel {self.name} received a malformed frame of type {frame_type} with {length} bytes")
+                    break
+                payload = recv_exactly(self.sock, length) if length else bytearray()
+                if payload is None:
+                    break
+                self.dispatch(frame_type, stream_id, payload)
+        except OSError as e:
+            if not self.closed:
+                logger.error(f"Tunnel {self.name} failed: {e}")
+        finally:
+            self.close()
+
+    def dispatch(self, frame_type: int, stream_id: int, payload: bytearray):
+        if frame_type == OPEN:
+            if self.on_open is None:
+                logger.error(f"Tunnel {self.name} received an unexpected OPEN for stream {stream_id}")
+                self.send_frame(RESET, stream_id)
+                return
+            stream = Stream(self, stream_id)
+            with self.lock:
+                self.streams[stream_id] = stream
+            self.on_open(self, stream)
+            return
+
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            # frames still in flight for a stream that already ended
+            return
+        if frame_type == DATA:
+            if not stream.deliver(payload):
+                # a peer ignoring the flow control window would make us buffer without bounds
+                logger.error(f"Stream {stream_id} on tunnel {self.name} exceeded its flow control window")
+                stream.abort()
+        elif frame_type == CLOSE:
+            stream.deliver(None)
+        elif frame_type == WINDOW:
+            stream.grant(WINDOW_CREDIT.unpack(payload)[0])
+        elif frame_type == RESET:
+            stream.reset()
+        else:
+            logger.error(f"Tunnel {self.name} received unknown frame type {frame_type}")
+
+    def close(self):
+        """Close the tunnel and reset all of its streams."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            streams = list(self.streams.values())
+        for stream in streams:
+            stream.reset()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        logger.info(f"Tunnel {self.name} closed")
+
+
+class TunnelPool:
+    """
+    The local end of the multiplexing mode, spreading client connections over at most max_tunnels tunnels.
+
+    Parameters:
+    - max_tunnels (int): the maximum number of tunnel sockets created with the socket factory.
+    - phase_timers (PhaseTimers): the timing counters the relay threads of the streams account to.
+    - profiler: a SocketSwap.profiling profiler the relay threads of the streams are wrapped with.
+
+    Notes:
+    - Tunnels are created lazily: a new client connection gets a new tunnel while there are less than max_tunnels
+      tunnels and all of them carry streams, otherwise it is opened on the tunnel with the fewest streams.
+    - Broken tunnels are dropped and replaced by new ones on demand.
+    """
+
+    def __init__(self, max_tunnels: int, phase_timers: Optional[PhaseTimers] = None, profiler=None):
+        if max_tunnels <= 0:
+            raise ValueError("max_tunnels must be positive")
+        self.max_tunnels = max_tunnels
+        self.phase_timers = phase_timers or NullPhaseTimers()
+        self.profiler = profiler
+        self.tunnels: List[Tunnel] = []
+        self.lock = threading.Lock()
+
+    def open_stream(self, local_socket: socket.socket, socket_factory: Callable[..., socket.socket], socket_factory_args, trace: ConnectionTrace) -> Stream:
+        """
+        Open a stream for a client connection.
+
+        Raises:
+        - socket.error: if a new tunnel is needed and the socket factory fails, or the chosen tunnel is broken.
+        """
+        return self.pick_tunnel(socket_factory, socket_factory_args, trace).open_stream(local_socket, trace)
+
+    def pick_tunnel(self, socket_factory, socket_factory_args, trace: ConnectionTrace) -> Tunnel:
+        # tunnels are created under the lock, so a burst of connections does not create more than max_tunnels
+        with self.lock:
+            self.tunnels = [tunnel for tunnel in self.tunnels if not tunnel.closed]
+            if self.tunnels:
+                tunnel = min(self.tunnels, key=lambda tunnel: tunnel.stream_count)
+                if tunnel.stream_count == 0 or len(self.tunnels) >= self.max_tunnels:
+                    return tunnel
+            trace.event("factory_start")
+            started = self.phase_timers.start()
+            try:
+                tunnel = Tunnel(socket_factory(*socket_factory_args), phase_timers=self.phase_timers, profiler=self.profiler).start()
+            except socket.error as e:
+                trace.event("factory_end", error=str(e))
+                raise
+            finally:
+                self.phase_timers.stop("factory", started)
+            trace.event("factory_end")
+            logger.info(f"Tunnel {tunnel.name} connected successfully")
+            self.tunnels.append(tunnel)
+            return tunnel
+
+    def stats(self) -> Dict[str, int]:
+        """Report the number of live tunnels and the streams they carry."""
+        with self.lock:
+            tunnels = [tunnel for tunnel in self.tunnels if not tunnel.closed]
+            return {"tunnels": len(tunnels), "streams": sum(tunnel.stream_count for tunnel in tunnels)}
+
+
+class MultiplexServer:
+    """
+    The far end of the multiplexing mode: accepts tunnel sockets and connects every stream to the target.
+
+    Parameters:
+    - target_factory (Callable): a function returning a socket connected to the target, called once per stream.
+    - target_factory_args: an iterable containing the arguments for the target_factory.
+    - host (str): the host to listen on for tunnel sockets.
+    - port (int): the port to listen on, 0 picks a free port, see the address attribute.
+
+    Notes:
+    - serve_forever() runs the server blocking. As a context manager the server runs in a daemon thread, which
+      makes it a local stand-in for the far end, e.g. for testing a socket factory connecting to its address.
+
+    Example:
+    >>> with MultiplexServer(target_factory, [], "127.0.0.1", 0) as far_end:
+    ...     with SocketSwapContext(tunnel_factory, [far_end.address], "127.0.0.1", 2222, multiplex_tunnels=2):
+    ...         ...
+    """
+
+    def __init__(self, target_factory: Callable[..., socket.socket], target_factory_args, host: str = "127.0.0.1", port: int = 0):
+        self.target_factory = target_factory
+        self.target_factory_args = target_factory_args
+        self.listening_socket = socket.create_server((host, port))
+        self.address = self.listening_socket.getsockname()[:2]
+        self.tunnels: List[Tunnel] = []
+        self.running = True
+
+    def serve_forever(self):
+        """Accept tunnel sockets until stop() is called."""
+        logger.info(f"Multiplex server listening on {self.address[0]}:{self.address[1]}")
+        while self.running:
+            try:
+                sock, _ = self.listening_socket.accept()
+            except OSError:
+                break
+            tunnel = Tunnel(sock, on_open=self.open_target)
+            self.tunnels = [tunnel for tunnel in self.tunnels if not tunnel.closed] + [tunnel]
+            tunnel.start()
+
+    def open_target(self, tunnel: Tunnel, stream: Stream):
+        # connect in a separate thread, a slow target must not stall the other streams of the tunnel
+        threading.Thread(target=self.connect_target, args=(tunnel, stream), daemon=True).start()
+
+    def connect_target(self, tunnel: Tunnel, stream: Stream):
+        try:
+            target_socket = self.target_factory(*self.target_factory_args)
+        except socket.error as e:
+            logger.error(f"SOCKET ERROR connecting target for stream {stream.stream_id} on tunnel {tunnel.name}: {e}")
+            stream.abort()
+            return
+        stream.attach(target_socket)
+
+    def start(self):
+        """Run the server in a daemon thread."""
+        threading.Thread(target=self.serve_forever, name="SocketSwapMultiplexServer", daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop accepting tunnels and close the open ones."""
+        self.running = False
+        try:
+            # wakes up the accept() in serve_forever, closing alone does not
+            self.listening_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listening_socket.close()
+        for tunnel in self.tunnels:
+            tunnel.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
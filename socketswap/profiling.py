@@ -0,0 +1,209 @@
+"""
+Module to profile the proxy process: per-phase timing counters, cProfile and a sampling profiler
+"""
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from typing import Callable, Dict
+
+
+PROFILE_MODES = ("phases", "cprofile", "sample")
+
+
+class PhaseTimers:
+    """
+    Timing counters for the phases of the relay loop (select wait, recv, send, logging, TLS, ...).
+
+    Notes:
+    - Every thread accumulates into its own counters, so the relay threads do not contend on a lock.
+      snapshot() sums the counters of all threads.
+    - Run the relay threads through wrap(), which folds the counters of a thread into the shared totals when it
+      ends, so the memory does not grow with the number of connections.
+    - Use start() and stop() around a phase:
+      >>> started = phase_timers.start()
+      >>> data = sock.recv(4096)
+      >>> phase_timers.stop("recv", started)
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._live_counters = {}
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def _counters(self) -> Dict[str, list]:
+        try:
+            return self._local.counters
+        except AttributeError:
+            counters = self._local.counters = {}
+            with self._lock:
+                # keyed by the dict itself, thread idents are reused once a thread ended
+                self._live_counters[id(counters)] = counters
+            return counters
+
+    def start(self) -> float:
+        """Return the start time of a phase."""
+        return time.perf_counter()
+
+    def stop(self, phase: str, started: float):
+        """Account the time since started to phase."""
+        elapsed = time.perf_counter() - started
+        counters = self._counters()
+        counter = counters.get(phase)
+        if counter is None:
+            counters[phase] = [1, elapsed, elapsed]
+        else:
+            counter[0] += 1
+            counter[1] += elapsed
+            if elapsed > counter[2]:
+                counter[2] = elapsed
+
+    def wrap(self, target: Callable) -> Callable:
+        """Return target wrapped to fold the counters of its thread into the shared totals when it returns."""
+        def timed(*args, **kwargs):
+            try:
+                return target(*args, **kwargs)
+            finally:
+                counters = getattr(self._local, "counters", None)
+                if counters is not None:
+                    with self._lock:
+                        self._live_counters.pop(id(counters), None)
+                        self._add(self._totals, counters)
+        return timed
+
+    @staticmethod
+    def _add(result: Dict[str, list], counters: Dict[str, list]):
+        for phase, (count, total, maximum) in list(counters.items()):
+            summary = result.setdefault(phase, [0, 0.0, 0.0])
+            summary[0] += count
+            summary[1] += total
+            summary[2] = max(summary[2], maximum)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """
+        Sum the counters of all threads.
+
+        Returns:
+        - A dict mapping each phase to its count, total and max duration in seconds.
+        """
+        result = {}
+        with self._lock:
+            self._add(result, self._totals)
+            for counters in self._live_counters.values():
+                self._add(result, counters)
+        return {phase: {"count": count, "total": total, "max": maximum} for phase, (count, total, maximum) in result.items()}
+
+
+class NullPhaseTimers:
+    """Stand-in for PhaseTimers when profiling is disabled, keeps the relay loop free of conditionals."""
+
+    def start(self) -> float:
+        return 0.0
+
+    def stop(self, phase: str, started: float):
+        pass
+
+    def wrap(self, target: Callable) -> Callable:
+        return target
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {}
+
+
+class CProfileProfiler:
+    """
+    Deterministic profiling of the proxy threads with cProfile.
+
+    Notes:
+    - cProfile only profiles the thread it is enabled in, so every thread started through wrap() runs its own
+      profiler, which is merged into the shared statistics when the thread ends. Connections that are still
+      open when the profile is dumped are not included yet.
+    """
+
+    def __init__(self):
+        self.stats = None
+        self.lock = threading.Lock()
+
+    def wrap(self, target: Callable) -> Callable:
+        """Return target wrapped to run under its own profiler."""
+        def profiled(*args, **kwargs):
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                return target(*args, **kwargs)
+            finally:
+                profiler.disable()
+                with self.lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profiler)
+                    else:
+                        self.stats.add(profiler)
+        return profiled
+
+    def dump(self, path: str) -> bool:
+        """Write the merged statistics in the pstats format, returns False if no thread finished yet."""
+        with self.lock:
+            if self.stats is None:
+                return False
+            self.stats.dump_stats(path)
+            return True
+
+
+class SamplingProfiler:
+    """
+    Statistical profiling of all threads of the proxy process.
+
+    Parameters:
+    - interval (float): seconds between two samples.
+
+    Notes:
+    - A daemon thread takes the stacks of all other threads every interval and counts them. The overhead does
+      not depend on the traffic, and long running connections are included, unlike with cProfile.
+    - dump() writes the counts in the collapsed stack format ("frame;frame;frame count" per line) read by
+      flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def wrap(self, target: Callable) -> Callable:
+        """Return target unchanged, the sampler covers all threads."""
+        return target
+
+    def start(self):
+        self.thread = threading.Thread(target=self.sample, name="SocketSwapSampler", daemon=True)
+        self.thread.start()
+        return self
+
+    def sample(self):
+        own_id = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(stack)))
+            with self.lock:
+                self.samples.update(stacks)
+
+    def dump(self, path: str) -> bool:
+        """Write the collapsed stacks, returns False if nothing was sampled yet."""
+        with self.lock:
+            if not self.samples:
+                return False
+            with open(path, "w") as f:
+                for stack, count in self.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            return True
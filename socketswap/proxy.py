@@ -1,7 +1,11 @@
 """
 Module to start a TCP proxy
 """
+import os
 import sys
+import pickle
+import stat
+import signal
 import threading
 import socket
 import ssl
@@ -10,63 +14,108 @@ import errno
 import logging
 from logging.handlers import QueueHandler
 from typing import Callable, List
+from SocketSwap.buffer_pool import BufferPool
+from SocketSwap.tracing import TRACE_FORMATS, TraceBuffer, ConnectionTrace, next_connection_id, start_trace_flusher, flush_traces
+from SocketSwap.multiplex import TunnelPool
+from SocketSwap.profiling import PROFILE_MODES, PhaseTimers, NullPhaseTimers, CProfileProfiler, SamplingProfiler
 
 
 logger = None
+# payload bytes included in the traffic log lines, the records are queued to the parent process without limit
+LOG_PAYLOAD_BYTES = 256
 proxy_socket = None
-
-def is_valid_ip4(ip):
-    """Check if a string is a valid IPv4 address.
+proxy_sockets = []
+unix_socket_path = None
+buffer_pool = None
+tunnel_pool = None
+phase_timers = NullPhaseTimers()
+profiler = None
+profile_output = None
+config = {}
+
+def format_address(address) -> str:
+    """Format a socket address for log lines and traces.
 
     Args:
-        ip (str): A string representing an IPv4 address in the format "X.X.X.X".
+        address: An address as returned by accept() or getpeername(), a (host, port) tuple for IPv4,
+            a (host, port, flowinfo, scope_id) tuple for IPv6 or a path string for Unix domain sockets.
 
     Returns:
-        bool: True if the input string is a valid IPv4 address, False otherwise.
-
-    Raises:
-        None.
-
-    This function splits the input string by periods and checks if it contains exactly 4 octets. It then verifies that each
-    octet is an integer between 0 and 255 inclusive. Returns True if the input string is a valid IPv4 address, False otherwise.
+        str: "host:port", "[host]:port" for IPv6 or "unix:path". Unnamed Unix domain socket peers yield "unix:".
     """
-    octets = ip.split(".")
-    if len(octets) != 4:
-        return False
-    return octets[0] != 0 and all(0 <= int(octet) <= 255 for octet in octets)
+    if isinstance(address, tuple):
+        if len(address) == 4:
+            return "[%s]:%d" % address[:2]
+        return "%s:%d" % address
+    if isinstance(address, bytes):
+        address = address.decode(errors="replace")
+    return f"unix:{address}"
 
 
-def receive_from(sock):
+def receive_from(sock, buffer_pool, max_buffers, timeout=1.0):
     """
-    Receive data from a socket until no more data is available.
+    Receive data from a socket into buffers taken from the shared buffer pool.
 
     Parameters:
     - sock (socket.socket): a socket object representing a network connection.
+    - buffer_pool (BufferPool): the pool the receive buffers are taken from.
+    - max_buffers (int): the maximum number of buffers a single call may hold (per-connection cap).
+    - timeout (float): seconds to wait for a first buffer if the pool budget is exhausted.
 
     Returns:
-    - A bytes object containing all the data received from the socket.
+    - A list of (buffer, nbytes) tuples holding the received data. A single tuple with nbytes 0 means the
+      connection was closed. An empty list means no buffer was available and nothing was read.
 
     Notes:
-    - This function receives data from the socket in chunks of 4096 bytes at a time, and concatenates them to a single bytes object.
-    - The function stops receiving data from the socket when either the socket connection is closed or the last chunk of data received is less than 4096 bytes.
-    - This function blocks until data is available from the socket or the socket is closed.
+    - This function receives data into slabs of the pool's slab size and stops when the last slab was not filled,
+      when no more data is waiting, when the connection is closed, when max_buffers slabs are held or when the
+      pool budget is exhausted. Only the first read may block.
+    - The caller owns the returned buffers and must hand them back with buffer_pool.release() once forwarded.
+    - Unread data stays in the kernel buffer, so an exhausted budget pushes back on the sender instead of growing memory.
 
     Example:
-    >>> import socket
-    >>> sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    >>> sock.connect(("www.google.com", 80))
-    >>> sock.sendall(b"GET / HTTP/1.1\r\nHost: www.google.com\r\n\r\n")
-    >>> response = receive_from(sock)
-    >>> print(response)
-    b'HTTP/1.1 200 OK\r\nDate: Fri, 23 Apr 2023 22:12:17 GMT\r\nServer: gws\r\nContent-Type: text/html; charset=ISO-8859-1\r\n...
+    >>> chunks = receive_from(sock, buffer_pool, 16)
+    >>> for buffer, nbytes in chunks:
+    ...     other_sock.sendall(memoryview(buffer)[:nbytes])
+    ...     buffer_pool.release(buffer)
     """
-    b = b""
-    while True:
-        data = sock.recv(4096)
-        b += data
-        if not data or len(data) < 4096:
+    chunks = []
+    while len(chunks) < max_buffers:
+        buffer = buffer_pool.acquire(None if chunks else timeout)
+        if buffer is None:
+            break
+        try:
+            nbytes = sock.recv_into(buffer)
+        except Exception:
+            buffer_pool.release(buffer)
+            for buffer, _ in chunks:
+                buffer_pool.release(buffer)
+            raise
+        chunks.append((buffer, nbytes))
+        if nbytes < len(buffer):
+            break
+        # a full slab may have taken the last data for now, only read on if more is waiting
+        if not (isinstance(sock, ssl.SSLSocket) and sock.pending()) and not select.select([sock], [], [], 0)[0]:
             break
-    return b
+    return chunks
+
+
+def select_readable(sockets: List[socket.socket]) -> List[socket.socket]:
+    """Wait until at least one of the sockets is readable.
+
+    Args:
+        sockets (List[socket.socket]): The sockets to wait for, plain or SSL sockets.
+
+    Returns:
+        List[socket.socket]: The readable sockets.
+
+    An SSL socket can hold already decrypted data in its own buffer, e.g. the rest of a record that receive_from
+    did not read because of the buffer cap. select() only sees the kernel buffer, so these sockets are reported
+    as readable without waiting and the other sockets are only polled.
+    """
+    pending = [sock for sock in sockets if isinstance(sock, ssl.SSLSocket) and sock.pending()]
+    read_sockets, _, _ = select.select(sockets, [], [], 0 if pending else None)
+    return pending + [sock for sock in read_sockets if sock not in pending]
 
 
 def is_client_hello(sock):
@@ -183,81 +232,319 @@ def starttls(use_ssl: bool, local_socket: socket.socket, read_sockets: List[sock
             )
 
 
-def proxy_thread(socket_factory: Callable[[], socket.socket], socket_factory_args, local_socket: socket.socket, use_ssl: bool, server_key: str, server_certificate: str, client_key: str, client_certificate: str):
+def proxy_thread(socket_factory: Callable[[], socket.socket], socket_factory_args, local_socket: socket.socket, use_ssl: bool, server_key: str, server_certificate: str, client_key: str, client_certificate: str, max_connection_buffers: int = 16, trace: ConnectionTrace = None):
     """handles each connection read/write in a seperate thread"""
+    if trace is None:
+        trace = ConnectionTrace(next_connection_id(), "")
+    conn = f"[conn {trace.conn_id}]"
+    close_reason = "error"
     try:
-        remote_socket = socket_factory(*socket_factory_args)
+        trace.event("factory_start")
+        started = phase_timers.start()
+        try:
+            remote_socket = socket_factory(*socket_factory_args)
+        except socket.error as socket_error:
+            trace.event("factory_end", error=str(socket_error))
+            close_reason = "factory_error"
+            logger.error(f"{conn} SOCKET ERROR connecting remote socket: {socket_error}")
+            local_socket.close()
+
+            # TODO braucht man hier den noch? (errno.errorcode[errnumber], os.strerror(errnumber))
+            if socket_error.errno not in (errno.ETIMEDOUT, errno.ECONNREFUSED):
+                raise socket_error
+            return None
+        finally:
+            phase_timers.stop("factory", started)
+        trace.event("factory_end")
+
+        logger.info(f"{conn} Remote Socket connected successfully")
+
+        running = True
+        while running:
+            started = phase_timers.start()
+            read_sockets = select_readable([remote_socket, local_socket])
+            phase_timers.stop("select", started)
+
+            if starttls(use_ssl, local_socket, read_sockets):
+                trace.event("tls_start")
+                started = phase_timers.start()
+                try:
+                    ssl_sockets = enable_ssl(server_key, server_certificate, client_key, client_certificate, remote_socket, local_socket)
+                    remote_socket, local_socket = ssl_sockets
+                    trace.event("tls_end")
+                    logger.info(f"{conn} SSL enabled")
+                except ssl.SSLError as e:
+                    trace.event("tls_end", error=str(e))
+                    close_reason = "tls_error"
+                    logger.error(f"{conn} SSL handshake failed: {e}")
+                    break
+                finally:
+                    phase_timers.stop("tls", started)
+
+                read_sockets = select_readable(ssl_sockets)
+
+            for sock in read_sockets:
+                started = phase_timers.start()
+                try:
+                    peer = sock.getpeername()
+                except socket.error as socket_error:
+                    if socket_error.errno == errno.ENOTCONN:
+                        # kind of a blind shot at fixing issue #15
+                        # I don't yet understand how this error can happen, but if it happens I'll just shut down the thread
+                        # the connection is not in a useful state anymore
+                        for s in [remote_socket, local_socket]:
+                            s.close()
+                        close_reason = "not_connected"
+                        running = False
+                        break
+                    else:
+                        logger.info(f"{conn} Socket exception in start_proxy_thread")
+                        raise socket_error
+                finally:
+                    phase_timers.stop("getpeername", started)
+
+                started = phase_timers.start()
+                chunks = receive_from(sock, buffer_pool, max_connection_buffers)
+                phase_timers.stop("recv", started)
+                if not chunks:
+                    logger.info(f"{conn} Buffer pool exhausted, deferring read")
+                    continue
+
+                try:
+                    received = sum(nbytes for _, nbytes in chunks)
+                    started = phase_timers.start()
+                    logger.info(f"{conn} Received {received} bytes")
+                    phase_timers.stop("logging", started)
+
+                    if sock == local_socket:
+                        if received:
+                            trace.transferred("out", received)
+                            for buffer, nbytes in chunks:
+                                data = memoryview(buffer)[:nbytes]
+                                started = phase_timers.start()
+                                logger.info(b'< < < out\n' + data[:LOG_PAYLOAD_BYTES])
+                                phase_timers.stop("logging", started)
+                                started = phase_timers.start()
+                                remote_socket.sendall(data)
+                                phase_timers.stop("send", started)
+                        else:
+                            logger.info(f"{conn} Connection from local client {format_address(peer)} closed")
+                            logger.info(f"{conn} Buffer pool usage: {buffer_pool.stats()}")
+                            remote_socket.close()
+                            close_reason = "local_closed"
+                            running = False
+                            break
+                    elif sock == remote_socket:
+                        if received:
+                            trace.transferred("in", received)
+                            for buffer, nbytes in chunks:
+                                data = memoryview(buffer)[:nbytes]
+                                started = phase_timers.start()
+                                logger.info(b'> > > in\n' + data[:LOG_PAYLOAD_BYTES])
+                                phase_timers.stop("logging", started)
+                                started = phase_timers.start()
+                                local_socket.sendall(data)
+                                phase_timers.stop("send", started)
+                        else:
+                            logger.info(f"{conn} Connection to remote server {format_address(peer)} closed")
+                            logger.info(f"{conn} Buffer pool usage: {buffer_pool.stats()}")
+                            local_socket.close()
+                            close_reason = "remote_closed"
+                            running = False
+                            break
+                finally:
+                    for buffer, _ in chunks:
+                        buffer_pool.release(buffer)
+    finally:
+        trace.close(close_reason)
+
+
+
+def multiplex_thread(socket_factory: Callable[[], socket.socket], socket_factory_args, local_socket: socket.socket, trace: ConnectionTrace):
+    """opens a stream for a connection on one of the shared tunnels, the stream relays in its own threads"""
+    conn = f"[conn {trace.conn_id}]"
+    try:
+        stream = tunnel_pool.open_stream(local_socket, socket_factory, socket_factory_args, trace)
     except socket.error as socket_error:
-        
-        logger.error(f"SOCKET ERROR connecting remote socket: {socket_error}")
+        logger.error(f"{conn} SOCKET ERROR opening multiplexed stream: {socket_error}")
         local_socket.close()
-            
-        # TODO braucht man hier den noch? (errno.errorcode[errnumber], os.strerror(errnumber))
-        if socket_error.errno not in (errno.ETIMEDOUT, errno.ECONNREFUSED):
-            raise socket_error
+        trace.close("factory_error")
         return None
-        
-    logger.info("Remote Socket connected successfully")
-    
-    running = True
-    while running:
-        read_sockets, _, _ = select.select([remote_socket, local_socket], [], [])
+    logger.info(f"{conn} Multiplexed as stream {stream.stream_id} on {stream.tunnel.name}")
 
-        if starttls(use_ssl, local_socket, read_sockets):
-            try:
-                ssl_sockets = enable_ssl(server_key, server_certificate, client_key, client_certificate, remote_socket, local_socket)
-                remote_socket, local_socket = ssl_sockets
-                logger.info("SSL enabled")
-            except ssl.SSLError as e:
-                logger.error(f"SSL handshake failed: {e}")
-                break
 
-            read_sockets, _, _ = select.select(ssl_sockets, [], [])
+def validate_config(new_config):
+    """
+    Check a proxy configuration before it is applied.
+
+    Args:
+        new_config (dict): The complete configuration as held in the module level config.
+
+    Raises:
+        ValueError: If the socket factory is not callable, the client certificate and key are not given in pairs,
+            a certificate chain cannot be loaded, a limit is not a positive integer or a setting does not apply
+            with multiplex_tunnels.
+        ssl.SSLError, OSError: If a certificate or key file cannot be loaded.
+    """
+    if not callable(new_config["socket_factory"]):
+        raise ValueError("socket_factory must be callable")
+    if (new_config["client_key"] is None) ^ (new_config["client_certificate"] is None):
+        raise ValueError("You must either specify both the client certificate and client key or leave both empty")
+    if new_config["server_certificate"] and new_config["server_key"]:
+        ssl.create_default_context(ssl.Purpose.CLIENT_AUTH).load_cert_chain(certfile=new_config["server_certificate"], keyfile=new_config["server_key"])
+    if new_config["client_certificate"] and new_config["client_key"]:
+        ssl.create_default_context(ssl.Purpose.SERVER_AUTH).load_cert_chain(certfile=new_config["client_certificate"], keyfile=new_config["client_key"])
+    if tunnel_pool is not None and new_config["use_ssl"]:
+        raise ValueError("TLS interception (use_ssl) is not supported with multiplex_tunnels")
+    if tunnel_pool is not None and any(new_config[limit] != config[limit] for limit in ("max_buffers", "max_connection_buffers")):
+        raise ValueError("The buffer limits do not apply with multiplex_tunnels, streams are bounded by their flow control window")
+    for limit in ("max_buffers", "max_connection_buffers"):
+        if not isinstance(new_config[limit], int) or new_config[limit] <= 0:
+            raise ValueError(f"{limit} must be a positive integer")
+
+
+def handle_control_command(command, arguments):
+    """
+    Apply a command received on the control channel.
+
+    Args:
+        command (str): "configure" to change settings, "stats" to report the proxy statistics or "profile_dump"
+            to write the profile, see dump_profile.
+        arguments (dict): For "configure" the settings to change, any of socket_factory, socket_factory_args,
+            server_key, server_certificate, client_key, client_certificate, use_ssl, max_buffers and max_connection_buffers.
+
+    Returns:
+        The statistics for "stats", the result of dump_profile for "profile_dump", None otherwise.
+
+    Raises:
+        ValueError: If the command or a setting is unknown or invalid.
+
+    New settings replace the module level config as a whole. Every connection takes its settings from the config
+    when it is accepted, so new settings apply to new connections while established connections keep theirs.
+    max_buffers is the exception, it resizes the buffer pool shared by all connections right away.
+    """
+    global config
+
+    if command == "stats":
+        stats = {"buffer_pool": buffer_pool.stats(), "phases": phase_timers.snapshot()}
+        if tunnel_pool is not None:
+            stats["multiplex"] = tunnel_pool.stats()
+        return stats
+    if command == "profile_dump":
+        return dump_profile()
+    if command != "configure":
+        raise ValueError(f"Unknown control command {command}")
+
+    unknown = set(arguments) - set(config)
+    if unknown:
+        raise ValueError(f"Unknown settings {', '.join(sorted(unknown))}")
+    new_config = dict(config)
+    new_config.update(arguments)
+    validate_config(new_config)
+    if new_config["max_buffers"] != buffer_pool.max_slabs:
+        buffer_pool.resize(new_config["max_buffers"])
+    config = new_config
+    logger.info(f"Proxy reconfigured: {', '.join(sorted(arguments))}")
+    return None
+
+
+def dump_profile():
+    """
+    Write the profile of the proxy process and log the per-phase timing counters.
+
+    Returns:
+        dict: The per-phase timing counters under "phases" (count, total and max seconds per phase) and the path
+            of the written profile under "profile_path", None if there was nothing to write.
+
+    The profile is written to profile_path, in the pstats format for the "cprofile" mode and in the collapsed
+    stack format for the "sample" mode.
+    """
+    phases = phase_timers.snapshot()
+    for phase, summary in sorted(phases.items(), key=lambda item: -item[1]["total"]):
+        logger.info(f"Phase {phase}: {summary['count']} times, {summary['total']:.6f}s total, {summary['max']:.6f}s max")
+    written = profiler is not None and profiler.dump(profile_output)
+    if written:
+        logger.info(f"Profile written to {profile_output}")
+    return {"phases": phases, "profile_path": profile_output if written else None}
+
+
+def start_control_thread(control_conn):
+    """
+    Serve the control channel of the proxy process in a daemon thread.
+
+    Args:
+        control_conn (multiprocessing.connection.Connection): The proxy end of the pipe to the parent process.
 
-        for sock in read_sockets:
+    Returns:
+        threading.Thread: The started thread.
+
+    Every request is a (sequence, command, pickled arguments) tuple and is answered with (sequence, "ok", result) or
+    (sequence, "error", message), so the parent can tell the answer apart from late answers to earlier requests.
+    The thread ends when the parent closes its end of the pipe.
+    """
+    def serve():
+        while True:
             try:
-                peer = sock.getpeername()
-            except socket.error as socket_error:
-                if socket_error.errno == errno.ENOTCONN:
-                    # kind of a blind shot at fixing issue #15
-                    # I don't yet understand how this error can happen, but if it happens I'll just shut down the thread
-                    # the connection is not in a useful state anymore
-                    for s in [remote_socket, local_socket]:
-                        s.close()
-                    running = False
-                    break
-                else:
-                    logger.info(f"Socket exception in start_proxy_thread")
-                    raise socket_error
-
-            data = receive_from(sock)
-            logger.info(f"Received {len(data)} bytes")
-
-            if sock == local_socket:
-                if len(data):
-                    logger.info( b'< < < out\n' + data)
-                    remote_socket.send(data.encode() if isinstance(data, str) else data)
-                else:
-                    logger.info( "Connection from local client %s:%d closed" % peer)
-                    remote_socket.close()
-                    running = False
-                    break
-            elif sock == remote_socket:
-                if len(data):
-                    logger.info( b'> > > in\n' + data)
-                    local_socket.send(data)
-                else:
-                    logger.info( "Connection to remote server %s:%d closed" % peer)
-                    local_socket.close()
-                    running = False
-                    break
-           
+                sequence, command, arguments = control_conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                arguments = pickle.loads(arguments)
+            except Exception as e:
+                # e.g. a socket factory that cannot be imported in the proxy process
+                control_conn.send((sequence, "error", f"Invalid control request: {e}"))
+                continue
+            try:
+                control_conn.send((sequence, "ok", handle_control_command(command, arguments)))
+            except Exception as e:
+                logger.error(f"Control command {command} failed: {e}")
+                control_conn.send((sequence, "error", str(e)))
+
+    thread = threading.Thread(target=serve, name="SocketSwapControl", daemon=True)
+    thread.start()
+    return thread
+
+
+def start_local_proxy(log_queue, socket_factory, socket_factory_args, local_host, local_port, server_key=None, server_certificate=None, client_key=None, client_certificate=None, use_ssl=False,
+                      buffer_size=4096, max_buffers=1024, max_connection_buffers=16,
+                      trace=False, trace_format="events", trace_buffer_size=4096, trace_flush_interval=1.0,
+                      control_conn=None, local_unix_socket=None, multiplex_tunnels=None,
+                      profile=None, profile_path=None, profile_interval=0.005):
+    """starts a local proxy server
+
+    The relay memory is bounded by a buffer pool shared by all connections: at most max_buffers buffers of
+    buffer_size bytes, of which a single connection holds at most max_connection_buffers at a time.
 
+    With trace enabled every connection records its lifecycle (accept, factory, TLS, first bytes, close) into a ring
+    buffer of trace_buffer_size records, which is flushed every trace_flush_interval seconds over the log queue
+    on the "SocketSwapProxy.trace" logger, either as event records or as OTLP/JSON spans (trace_format "otlp").
 
-def start_local_proxy(log_queue, socket_factory, socket_factory_args, local_host, local_port, server_key=None, server_certificate=None, client_key=None, client_certificate=None, use_ssl=False):
-    """starts a local proxy server"""
+    control_conn is the proxy end of a multiprocessing pipe used to reconfigure the running proxy,
+    see handle_control_command.
+
+    local_host may be an IPv4 or IPv6 address or a host name, "::" listens dual-stack on IPv4 and IPv6.
+    With local_unix_socket the proxy additionally listens on a Unix domain socket at that path,
+    local_host can then be None to listen on the Unix domain socket only.
+
+    With multiplex_tunnels the client connections are multiplexed as streams over at most that many sockets created
+    by the socket factory. The far end of these tunnel sockets has to be a SocketSwap.multiplex.MultiplexServer.
+    The streams do not relay through the buffer pool, each one is bounded by its flow control window
+    (SocketSwap.multiplex.STREAM_WINDOW) instead, so buffer_size, max_buffers and max_connection_buffers are ignored.
+
+    profile enables per-phase timing counters of the relay loop ("phases"), additionally with cProfile ("cprofile")
+    or a sampling profiler taking a sample every profile_interval seconds ("sample"). The profile is written to
+    profile_path when the proxy stops or on the "profile_dump" control command.
+    """
     global proxy_socket
+    global proxy_sockets
+    global unix_socket_path
     global logger
+    global buffer_pool
+    global tunnel_pool
+    global phase_timers
+    global profiler
+    global profile_output
+    global config
     
     logger = logging.getLogger("SocketSwapProxy")
     logger.addHandler(QueueHandler(log_queue))
@@ -269,59 +556,190 @@ def start_local_proxy(log_queue, socket_factory, socket_factory_args, local_host
         logger.error("You must either specify both the client certificate and client key or leave both empty")
         sys.exit(8)
 
-    if local_host != '0.0.0.0' and not is_valid_ip4(local_host):
+    try:
+        buffer_pool = BufferPool(buffer_size, max_buffers)
+    except ValueError as e:
+        logger.error(f"Invalid buffer pool configuration: {e}")
+        sys.exit(9)
+    if max_connection_buffers <= 0:
+        logger.error("max_connection_buffers must be positive")
+        sys.exit(9)
+
+    trace_buffer = None
+    if trace:
+        if trace_format not in TRACE_FORMATS:
+            logger.error(f"Unknown trace format {trace_format}, use one of {', '.join(TRACE_FORMATS)}")
+            sys.exit(10)
+        trace_buffer = TraceBuffer(trace_buffer_size)
+        start_trace_flusher(trace_buffer, logging.getLogger("SocketSwapProxy.trace"), trace_format, trace_flush_interval)
+
+    if profile is not None:
+        if profile not in PROFILE_MODES:
+            logger.error(f"Unknown profile mode {profile}, use one of {', '.join(PROFILE_MODES)}")
+            sys.exit(12)
+        phase_timers = PhaseTimers()
+        if profile == "cprofile":
+            profiler = CProfileProfiler()
+            profile_output = profile_path or "socketswap.prof"
+        elif profile == "sample":
+            profiler = SamplingProfiler(profile_interval).start()
+            profile_output = profile_path or "socketswap.collapsed"
+
+    if multiplex_tunnels is not None:
+        if use_ssl:
+            logger.error("TLS interception (use_ssl) is not supported with multiplex_tunnels")
+            sys.exit(11)
         try:
-            ip = socket.gethostbyname(local_host)
+            tunnel_pool = TunnelPool(multiplex_tunnels, phase_timers, profiler)
+        except ValueError as e:
+            logger.error(f"Invalid multiplex configuration: {e}")
+            sys.exit(11)
+
+    config = {
+        "socket_factory": socket_factory,
+        "socket_factory_args": socket_factory_args,
+        "server_key": server_key,
+        "server_certificate": server_certificate,
+        "client_key": client_key,
+        "client_certificate": client_certificate,
+        "use_ssl": use_ssl,
+        "max_buffers": max_buffers,
+        "max_connection_buffers": max_connection_buffers,
+    }
+    if control_conn is not None:
+        start_control_thread(control_conn)
+
+    if local_host is None and local_unix_socket is None:
+        logger.error("You must specify a listening host, a Unix domain socket path or both")
+        sys.exit(1)
+
+    if local_host is not None:
+        try:
+            addresses = socket.getaddrinfo(local_host, local_port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)
         except socket.gaierror:
-            ip = False
-        if ip is False:
             logger.error(f"Provided listening host is not a valid IP address or host name: {local_host}")
             sys.exit(1)
-        else:
-            local_host = ip
 
+        # prefer the IPv4 address of a host name like gethostbyname did, "localhost" may resolve to ::1 first
+        # and IPv4 clients would be refused. IPv6 literals like "::" only resolve to IPv6.
+        family, socktype, proto, _, address = min(addresses, key=lambda info: info[0] != socket.AF_INET)
 
-    # local proxy socket
-    proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # local proxy socket
+        tcp_socket = socket.socket(family, socktype, proto)
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if family == socket.AF_INET6 and address[0] == "::":
+            # dual-stack, accept IPv4 clients as IPv4-mapped addresses as well
+            tcp_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
 
-    try:
-        proxy_socket.bind((local_host, local_port))
-    except socket.error as e:
-        logger.error(e.strerror)
-        sys.exit(5)
+        try:
+            tcp_socket.bind(address)
+        except socket.error as e:
+            logger.error(e.strerror)
+            sys.exit(5)
+        proxy_sockets.append(tcp_socket)
+
+    if local_unix_socket is not None:
+        if not hasattr(socket, "AF_UNIX"):
+            logger.error("Unix domain sockets are not supported on this platform")
+            sys.exit(5)
+        # remove a socket file left behind by a previous run, but never any other kind of file
+        if os.path.exists(local_unix_socket) and stat.S_ISSOCK(os.stat(local_unix_socket).st_mode):
+            os.unlink(local_unix_socket)
+        unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            unix_socket.bind(local_unix_socket)
+        except socket.error as e:
+            logger.error(e.strerror)
+            sys.exit(5)
+        unix_socket_path = local_unix_socket
+        proxy_sockets.append(unix_socket)
+
+    for listening_socket in proxy_sockets:
+        listening_socket.listen(100)
+        logger.info(f"Listening on {format_address(listening_socket.getsockname())}")
+    proxy_socket = proxy_sockets[0]
+
+    def shutdown():
+        stop_local_proxy()
+        if profile is not None:
+            dump_profile()
+        if trace_buffer is not None:
+            flush_traces(trace_buffer, logging.getLogger("SocketSwapProxy.trace"), trace_format)
+
+    def terminate(signum, frame):
+        # SocketSwapContext stops the proxy process with SIGTERM. Clean up, hand the last log records to the parent
+        # and exit right away, sys.exit would wait for the relay threads of the open connections.
+        shutdown()
+        if hasattr(log_queue, "join_thread"):
+            log_queue.close()
+            log_queue.join_thread()
+        os._exit(0)
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, terminate)
 
-    proxy_socket.listen(100)
     try:
         while True:
-            in_socket, in_addrinfo = proxy_socket.accept()
-            logger.info( 'Connection from %s:%d' % in_addrinfo)
-            pthread = threading.Thread(
-                target=proxy_thread, 
-                args=(socket_factory, socket_factory_args, in_socket, use_ssl, server_key, server_certificate, client_key, client_certificate)
-            )
-            logger.info(f"Starting proxy thread {pthread.name}")
-            pthread.start()
+            ready_sockets, _, _ = select.select(proxy_sockets, [], [])
+            for listening_socket in ready_sockets:
+                accept_connection(listening_socket, trace_buffer, trace_format)
     except KeyboardInterrupt as e:
         logger.info(e)
         sys.exit(0)
+    finally:
+        shutdown()
+
+
+def accept_connection(listening_socket: socket.socket, trace_buffer: TraceBuffer, trace_format: str):
+    """accepts a connection on a listening socket and starts its proxy thread"""
+    in_socket, in_addrinfo = listening_socket.accept()
+    # the config is replaced as a whole on reconfiguration, so this connection sees a consistent snapshot
+    current = config
+    peer = format_address(in_addrinfo)
+    conn_trace = ConnectionTrace(next_connection_id(), peer, trace_buffer, trace_format)
+    conn_trace.event("accept", peer=peer)
+    logger.info(f"[conn {conn_trace.conn_id}] Connection from {peer}")
+    if tunnel_pool is not None:
+        target = phase_timers.wrap(multiplex_thread)
+        pthread = threading.Thread(
+            target=profiler.wrap(target) if profiler else target,
+            args=(current["socket_factory"], current["socket_factory_args"], in_socket, conn_trace)
+        )
+        logger.info(f"[conn {conn_trace.conn_id}] Starting multiplex thread {pthread.name}")
+        pthread.start()
+        return
+    target = phase_timers.wrap(proxy_thread)
+    pthread = threading.Thread(
+        target=profiler.wrap(target) if profiler else target,
+        args=(current["socket_factory"], current["socket_factory_args"], in_socket, current["use_ssl"],
+              current["server_key"], current["server_certificate"], current["client_key"], current["client_certificate"],
+              current["max_connection_buffers"], conn_trace)
+    )
+    logger.info(f"[conn {conn_trace.conn_id}] Starting proxy thread {pthread.name}")
+    pthread.start()
 
 
 
 def stop_local_proxy():
     """
-    Stops the local proxy server by closing the listening socket.
+    Stops the local proxy server by closing the listening sockets and removing the Unix domain socket file.
 
     Note:
-    This function uses a global variable proxy_socket to store the socket object. If proxy_socket is not defined
-    or is already closed, no action will be taken.
+    This function uses the global variables proxy_sockets and unix_socket_path to find the listening sockets.
+    If they are not defined or already closed, no action will be taken.
     """
-    global proxy_socket
-    try:
-        if proxy_socket:
-            proxy_socket.close()
-    except Exception as e:
-        logger.error(f"Exception on closing listening socket: {e}")
+    global unix_socket_path
+    for listening_socket in proxy_sockets:
+        try:
+            listening_socket.close()
+        except Exception as e:
+            logger.error(f"Exception on closing listening socket: {e}")
+    if unix_socket_path:
+        try:
+            os.unlink(unix_socket_path)
+        except FileNotFoundError:
+            pass
+        unix_socket_path = None
 
 
 if __name__ == '__main__':
@@ -0,0 +1,205 @@
+"""
+Module to trace the lifecycle of proxied connections and ship the trace records to the parent process
+"""
+import os
+import json
+import time
+import logging
+import itertools
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+
+TRACE_FORMATS = ("events", "otlp")
+
+_connection_ids = itertools.count(1)
+
+
+def next_connection_id() -> int:
+    """Return a new connection ID, unique within the proxy process."""
+    return next(_connection_ids)
+
+
+class TraceBuffer:
+    """
+    A bounded ring buffer for trace records.
+
+    Parameters:
+    - capacity (int): the maximum number of records kept. When the buffer is full the oldest records are dropped.
+
+    Notes:
+    - The buffer is backed by a collections.deque with a maxlen. Its append and popleft are atomic, so the proxy
+      threads push records without taking a lock and a single flusher drains them.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        self._records = deque(maxlen=capacity)
+
+    def push(self, record: Dict):
+        """Append a record, dropping the oldest one if the buffer is full."""
+        self._records.append(record)
+
+    def drain(self) -> List[Dict]:
+        """Remove and return all records currently in the buffer, oldest first."""
+        batch = []
+        try:
+            while True:
+                batch.append(self._records.popleft())
+        except IndexError:
+            pass
+        return batch
+
+
+class ConnectionTrace:
+    """
+    The lifecycle timeline of a single proxied connection.
+
+    Parameters:
+    - conn_id (int): the ID of the connection, see next_connection_id().
+    - peer (str): the address of the local client.
+    - buffer (TraceBuffer): the buffer the records are pushed to. None disables tracing, the trace then only carries the ID.
+    - trace_format (str): "events" pushes every event as a record, "otlp" pushes one span per connection when it closes.
+
+    Notes:
+    - Every event carries a wall clock timestamp in nanoseconds (time_unix_nano) and optional attributes.
+    - Byte totals are counted per direction: "out" is local client to remote, "in" is remote to local client.
+      The first byte of each direction is recorded as a first_byte_out / first_byte_in event.
+    """
+
+    def __init__(self, conn_id: int, peer: str, buffer: Optional[TraceBuffer] = None, trace_format: str = "events"):
+        self.conn_id = conn_id
+        self.peer = peer
+        self.buffer = buffer
+        self.trace_format = trace_format
+        self.bytes = {"out": 0, "in": 0}
+        self.events = []
+        self.closed = False
+
+    def event(self, name: str, **attributes):
+        """Record a lifecycle event."""
+        if self.buffer is None:
+            return
+        record = {"conn_id": self.conn_id, "event": name, "time_unix_nano": time.time_ns()}
+        record.update(attributes)
+        if self.trace_format == "otlp":
+            self.events.append(record)
+        else:
+            self.buffer.push(record)
+
+    def transferred(self, direction: str, nbytes: int):
+        """Count nbytes relayed in the given direction ("out" or "in")."""
+        if not self.bytes[direction]:
+            self.event(f"first_byte_{direction}")
+        self.bytes[direction] += nbytes
+
+    def close(self, reason: str):
+        """Record the close event with the close reason and byte totals. Only the first call has an effect."""
+        if self.closed:
+            return
+        self.closed = True
+        self.event("close", reason=reason, bytes_out=self.bytes["out"], bytes_in=self.bytes["in"])
+        if self.buffer is not None and self.trace_format == "otlp":
+            self.buffer.push(to_otlp_span(self.conn_id, self.peer, self.events))
+
+
+def _otlp_attributes(attributes: Dict) -> List[Dict]:
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            result.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            result.append({"key": key, "value": {"intValue": str(value)}})
+        else:
+            result.append({"key": key, "value": {"stringValue": str(value)}})
+    return result
+
+
+def to_otlp_span(conn_id: int, peer: str, events: List[Dict]) -> Dict:
+    """
+    Convert the timeline of a connection to a span in the OTLP/JSON encoding.
+
+    Parameters:
+    - conn_id (int): the ID of the connection.
+    - peer (str): the address of the local client.
+    - events (List[Dict]): the event records of the connection, the last one being its close event.
+
+    Returns:
+    - A dict representing an OpenTelemetry span. The span starts with the first event and ends with the last one,
+      every event becomes a span event and the close reason and byte totals become span attributes.
+    """
+    close = events[-1] if events else {}
+    attributes = {"socketswap.conn_id": conn_id, "net.peer.name": peer}
+    for key in ("reason", "bytes_out", "bytes_in"):
+        if key in close:
+            attributes[f"socketswap.{key}"] = close[key]
+    span_events = []
+    for record in events:
+        event_attributes = {k: v for k, v in record.items() if k not in ("conn_id", "event", "time_unix_nano")}
+        span_events.append({
+            "timeUnixNano": str(record["time_unix_nano"]),
+            "name": record["event"],
+            "attributes": _otlp_attributes(event_attributes),
+        })
+    return {
+        "traceId": os.urandom(16).hex(),
+        "spanId": os.urandom(8).hex(),
+        "name": "socketswap.connection",
+        "kind": 2,  # SPAN_KIND_SERVER
+        "startTimeUnixNano": str(events[0]["time_unix_nano"]) if events else "0",
+        "endTimeUnixNano": str(close.get("time_unix_nano", 0)),
+        "attributes": _otlp_attributes(attributes),
+        "events": span_events,
+    }
+
+
+def to_otlp_json(spans: List[Dict]) -> str:
+    """Wrap spans created by to_otlp_span() in an OTLP/JSON ExportTraceServiceRequest document."""
+    return json.dumps({
+        "resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": "SocketSwap"})},
+            "scopeSpans": [{
+                "scope": {"name": "SocketSwap"},
+                "spans": spans,
+            }],
+        }]
+    })
+
+
+def flush_traces(buffer: TraceBuffer, logger: logging.Logger, trace_format: str = "events"):
+    """
+    Drain the trace buffer and log its records as a single batch.
+
+    Parameters:
+    - buffer (TraceBuffer): the buffer to drain.
+    - logger (logging.Logger): the logger to emit the batch on, typically one forwarding to the parent's log queue.
+    - trace_format (str): "events" logs the batch in the trace_events attribute of the record, "otlp" logs the
+      batch as an OTLP/JSON document in the message and the spans in the trace_spans attribute.
+    """
+    batch = buffer.drain()
+    if not batch:
+        return
+    if trace_format == "otlp":
+        logger.info(to_otlp_json(batch), extra={"trace_spans": batch})
+    else:
+        logger.info(f"Trace batch of {len(batch)} events", extra={"trace_events": batch})
+
+
+def start_trace_flusher(buffer: TraceBuffer, logger: logging.Logger, trace_format: str = "events", interval: float = 1.0) -> threading.Thread:
+    """
+    Start a daemon thread that calls flush_traces() every interval seconds.
+
+    Returns:
+    - The started thread.
+
+    Notes:
+    - The thread does not flush on shutdown, call flush_traces() once more when the proxy stops.
+    """
+    def flush():
+        while True:
+            time.sleep(interval)
+            flush_traces(buffer, logger, trace_format)
+
+    thread = threading.Thread(target=flush, name="SocketSwapTraceFlusher", daemon=True)
+    thread.start()
+    return thread